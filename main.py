@@ -1,18 +1,43 @@
 import os
-import json
+import re
+import ssl
+import sys
 import asyncio
-from urllib.parse import parse_qs
-import traceback
+import base64
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from functools import lru_cache
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 
 import aiohttp
+import msgspec
+import orjson
 
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi.websockets import WebSocketState
+from fastapi.responses import ORJSONResponse, Response
 from twilio.twiml.voice_response import VoiceResponse, Connect
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# Deployments launch via the uvicorn CLI (see Dockerfile), which never runs
+# the __main__ block below, so install uvloop at import so every entrypoint
+# gets the fast loop.
+if sys.platform != "win32":
+    import uvloop
+    uvloop.install()
+
+# Log records are queued and written by a background thread so the event loop
+# never blocks on stdout, even for lifecycle messages.
+_log_queue = SimpleQueue()
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s", handlers=[QueueHandler(_log_queue)])
+_log_listener = QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+log = logging.getLogger(__name__)
+
 # --- Configuration ---
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 PUBLIC_URL = os.getenv("PUBLIC_URL")
@@ -23,130 +48,393 @@ VOICE_ID = "alloy"
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY is missing from Railway Variables.")
 
-app = FastAPI()
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+async def create_http_session():
+    # One shared session for every call: connects to OpenAI reuse warm
+    # connections and cached DNS instead of paying a fresh handshake per call.
+    # A single SSLContext keeps a process-wide TLS session cache, so repeat
+    # handshakes to api.openai.com resume via session tickets instead of
+    # redoing the full key exchange.
+    ssl_ctx = ssl.create_default_context()
+    ssl_ctx.options |= ssl.OP_NO_COMPRESSION
+    app.state.http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=0,
+            ttl_dns_cache=300,
+            keepalive_timeout=60,
+            ssl=ssl_ctx,
+            enable_cleanup_closed=True,
+        )
+    )
+    try:
+        # Pre-warm DNS and the TLS session cache so the first call is fast too.
+        async with app.state.http.head("https://api.openai.com/", allow_redirects=False):
+            pass
+    except aiohttp.ClientError:
+        pass
+
+@app.on_event("shutdown")
+async def close_http_session():
+    await app.state.http.close()
+
+# Fast path for the dominant OpenAI event: pull "delta" straight out of the
+# raw frame instead of parsing the whole event dict. Only audio deltas carry
+# a "delta" field next to this exact type string; everything else falls back
+# to a full parse.
+_AUDIO_DELTA_RE = re.compile(r'"type"\s*:\s*"response\.audio\.delta".*?"delta"\s*:\s*"([^"]+)"', re.S)
+_MEDIA_SUFFIX = '"}}'
+# Inbound fast path: a Twilio media frame is the only frame carrying a
+# "payload" key, and the base64 string is forwarded verbatim, so it can be
+# sliced out of the raw frame and spliced into the append template without
+# parsing or re-serializing anything.
+_PAYLOAD_KEY = '"payload":"'
+_APPEND_PREFIX = '{"type":"input_audio_buffer.append","audio":"'
+_APPEND_SUFFIX = '"}'
+_INPUT_COMMIT = '{"type":"input_audio_buffer.commit"}'
 
-@app.get("/", response_class=JSONResponse)
+# Typed decoders for the two message shapes the relay actually inspects.
+# msgspec decodes straight into structs, skipping unknown fields at C speed
+# with no intermediate dict.
+class TwilioStart(msgspec.Struct):
+    streamSid: str
+
+class TwilioMedia(msgspec.Struct):
+    payload: str
+
+class TwilioFrame(msgspec.Struct):
+    event: str
+    start: TwilioStart | None = None
+    media: TwilioMedia | None = None
+
+class OpenAIEvent(msgspec.Struct):
+    type: str
+    delta: str | None = None
+
+_twilio_decoder = msgspec.json.Decoder(TwilioFrame)
+_openai_decoder = msgspec.json.Decoder(OpenAIEvent)
+
+# Non-delta OpenAI events (transcripts, session state) can be large; parsing
+# them off-loop keeps the audio latency budget intact during bursts.
+_LARGE_EVENT_BYTES = 4096
+_json_pool = ThreadPoolExecutor(max_workers=2)
+# Upper bound on a coalesced outbound payload; keeps merged frames modest while
+# still collapsing a backlog of small deltas into a single send.
+_MAX_COALESCED_B64 = 4096
+# Cap on buffered outbound deltas; beyond this the oldest audio is dropped,
+# since stale real-time audio is worse than a small gap.
+_MAX_PENDING_DELTAS = 64
+# Cap on buffered inbound appends. Unlike playback audio, caller speech must
+# never be dropped, so a full queue blocks the Twilio reader instead.
+_MAX_PENDING_APPENDS = 64
+# 20 ms of mu-law silence, sent while OpenAI is quiet so Twilio never sees an
+# idle stream.
+_SILENCE_B64 = base64.b64encode(b"\xff" * 160).decode()
+_KEEPALIVE_INTERVAL = 5.0
+
+@app.get("/")
 async def health():
     return {"status": "ok"}
 
-@app.api_route("/incoming-call", methods=["GET", "POST"])
-async def inbound_call(_: Request):
+def _inbound_twiml() -> bytes:
     response = VoiceResponse()
     gather = response.gather(action="/language-selection", method="POST", num_digits=1, timeout=5)
     gather.say("You have reached the employee tip line. For English, please stay on the line.", voice="Polly.Matthew-Neural")
     gather.pause(length=1)
     gather.say("Para español, presione uno.", voice="Polly.Lupe-Neural")
     response.redirect("/language-selection")
-    return HTMLResponse(str(response), media_type="application/xml")
-
-@app.api_route("/language-selection", methods=["GET", "POST"])
-async def language_selection(request: Request):
-    body = (await request.body()).decode()
-    digits = parse_qs(body).get("Digits", [""])[0]
-    lang = "es" if digits.strip() == "1" else "en"
-
-    domain = PUBLIC_URL or request.headers.get("host")
-    ws_url = f"wss://{domain}/media-stream/{lang}"
+    return str(response).encode()
 
+@lru_cache(maxsize=8)
+def _connect_twiml(domain: str, lang: str) -> bytes:
     response = VoiceResponse()
     connect = Connect()
-    connect.stream(url=ws_url)
+    connect.stream(url=f"wss://{domain}/media-stream/{lang}")
     response.append(connect)
     response.pause(length=15)
     response.say("We're sorry, but there was an issue connecting. Please call back later.")
-    return HTMLResponse(str(response), media_type="application/xml")
+    return str(response).encode()
+
+# The inbound TwiML never varies; render it once at import. The connect TwiML
+# only varies by (domain, lang), which the lru_cache above covers.
+_INBOUND_TWIML = _inbound_twiml()
+
+@app.api_route("/incoming-call", methods=["GET", "POST"])
+async def inbound_call(_: Request):
+    return Response(_INBOUND_TWIML, media_type="application/xml")
+
+@app.api_route("/language-selection", methods=["GET", "POST"])
+async def language_selection(request: Request):
+    # Only the single Digits field matters; scan for it directly instead of
+    # decoding and dict-ifying the whole form body.
+    body = await request.body()
+    i = body.find(b"Digits=")
+    lang = "es" if i != -1 and body[i + 7:i + 8] == b"1" else "en"
+
+    domain = PUBLIC_URL or request.headers.get("host")
+    return Response(_connect_twiml(domain, lang), media_type="application/xml")
+
+async def iter_ws_frames(ws: WebSocket):
+    """Yield raw Twilio frames, bypassing Starlette's text-only iterator.
+
+    `iter_text()` insists on decoded text frames; reading the ASGI message
+    directly passes bytes frames through untouched, and both consumers — the
+    payload fast-path scan and the msgspec fallback decoder — accept str and
+    bytes alike, so no extra UTF-8 decode pass is forced on the hot path.
+    """
+    while True:
+        message = await ws.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        raw = message.get("bytes")
+        if raw is None:
+            raw = message.get("text")
+        if raw is not None:
+            yield raw
 
 @app.websocket("/media-stream/{lang}")
 async def media_stream(websocket: WebSocket, lang: str):
     await websocket.accept()
-    print(f"WebSocket connection accepted for language: {lang}")
+    log.info("WebSocket connection accepted for language: %s", lang)
 
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.ws_connect(
-                f"wss://api.openai.com/v1/realtime?model={MODEL}",
-                headers={
-                    "Authorization": f"Bearer {OPENAI_API_KEY}",
-                    "OpenAI-Beta": "realtime=v1",
-                }
-            ) as ai_websocket:
-                print("Successfully connected to OpenAI.")
-                
-                await setup_session(ai_websocket, lang)
-                await asyncio.sleep(0.25)
-                await send_greeting(ai_websocket, lang)
-
-                stream_sid = None
-                has_received_media = False
-
-                async def twilio_to_openai():
-                    nonlocal stream_sid, has_received_media
-                    try:
-                        async for raw in websocket.iter_text():
-                            data = json.loads(raw)
-                            event = data.get("event")
-                            if event == "start":
-                                stream_sid = data["start"]["streamSid"]
-                            elif event == "media":
+        async with app.state.http.ws_connect(
+            f"wss://api.openai.com/v1/realtime?model={MODEL}",
+            headers={
+                "Authorization": f"Bearer {OPENAI_API_KEY}",
+                "OpenAI-Beta": "realtime=v1",
+            },
+            compress=0,
+            max_msg_size=0,
+        ) as ai_websocket:
+            log.info("Successfully connected to OpenAI.")
+
+            try:
+                # Default watermarks force a drain await every few frames at
+                # this message rate; a bigger buffer lets TCP apply the real
+                # back-pressure. Private attribute, so best-effort only.
+                ai_websocket._writer.transport.set_write_buffer_limits(high=1 << 20)
+            except AttributeError:
+                pass
+
+            await setup_session(ai_websocket, lang)
+            # Fire the greeting as soon as OpenAI acknowledges the session
+            # instead of always sleeping 250 ms; the old sleep remains only
+            # as the timeout if no acknowledgement arrives.
+            try:
+                await asyncio.wait_for(ai_websocket.receive(), timeout=0.25)
+            except asyncio.TimeoutError:
+                pass
+            await send_greeting(ai_websocket, lang)
+
+            stream_sid = None
+            media_prefix = None
+            sid_ready = asyncio.Event()
+            has_received_media = False
+
+            loop = asyncio.get_running_loop()
+
+            # Twilio -> OpenAI gets the same reader/writer split as the other
+            # direction: the reader only parses and enqueues, so a slow OpenAI
+            # send can never block draining the Twilio socket.
+            to_openai = deque()
+            openai_wake = loop.create_future()
+            openai_space = loop.create_future()
+
+            async def push_openai(message):
+                nonlocal openai_space
+                # Dropping here would discard caller speech (or a queued
+                # commit), so a full queue waits for the writer to drain; the
+                # stalled reader then pushes back on Twilio via TCP. The None
+                # sentinel always goes through so teardown can't block.
+                while message is not None and len(to_openai) >= _MAX_PENDING_APPENDS:
+                    openai_space = loop.create_future()
+                    await openai_space
+                to_openai.append(message)
+                if not openai_wake.done():
+                    openai_wake.set_result(None)
+
+            async def twilio_to_openai():
+                nonlocal stream_sid, media_prefix, has_received_media
+                try:
+                    async for raw in iter_ws_frames(websocket):
+                        if isinstance(raw, str):
+                            i = raw.find(_PAYLOAD_KEY)
+                            if i != -1:
+                                i += len(_PAYLOAD_KEY)
                                 has_received_media = True
-                                await ai_websocket.send_str(json.dumps({"type": "input_audio_buffer.append", "audio": data["media"]["payload"]}))
-                            elif event == "stop":
-                                if has_received_media:
-                                    await asyncio.sleep(0.15)
-                                    await ai_websocket.send_str(json.dumps({"type": "input_audio_buffer.commit"}))
-                                    has_received_media = False
-                    except WebSocketDisconnect:
-                        print("Twilio WebSocket disconnected.")
-
-                async def openai_to_twilio():
-                    try:
-                        async for msg in ai_websocket:
-                            if msg.type == aiohttp.WSMsgType.TEXT:
-                                data = json.loads(msg.data)
-                                if data.get("type") == "response.audio.delta" and "delta" in data:
-                                    await websocket.send_json({"event": "media", "streamSid": stream_sid, "media": {"payload": data["delta"]}})
-                            elif msg.type == aiohttp.WSMsgType.ERROR:
-                                print(f"OpenAI WebSocket error: {msg}")
-                    except Exception:
-                        print("OpenAI connection closed.")
-
-                await asyncio.gather(twilio_to_openai(), openai_to_twilio())
+                                await push_openai(_APPEND_PREFIX + raw[i:raw.index('"', i)] + _APPEND_SUFFIX)
+                                continue
+                        frame = _twilio_decoder.decode(raw)
+                        event = frame.event
+                        if event == "start":
+                            stream_sid = frame.start.streamSid
+                            media_prefix = '{"event":"media","streamSid":"' + stream_sid + '","media":{"payload":"'
+                            sid_ready.set()
+                        elif event == "media":
+                            has_received_media = True
+                            await push_openai(_APPEND_PREFIX + frame.media.payload + _APPEND_SUFFIX)
+                        elif event == "stop":
+                            if has_received_media:
+                                await asyncio.sleep(0.15)
+                                await push_openai(_INPUT_COMMIT)
+                                has_received_media = False
+                except WebSocketDisconnect:
+                    log.info("Twilio WebSocket disconnected.")
+                finally:
+                    # Unblock the writer even if the call ended before "start".
+                    sid_ready.set()
+                    await push_openai(None)
+                    # A Twilio hangup must also stop twilio_writer, or its next
+                    # send (at latest the keepalive) hits the dead socket.
+                    push_delta(None)
+
+            async def openai_writer():
+                nonlocal openai_wake
+                send_str = ai_websocket.send_str
+                while True:
+                    while not to_openai:
+                        openai_wake = loop.create_future()
+                        await openai_wake
+                    message = to_openai.popleft()
+                    if not openai_space.done():
+                        openai_space.set_result(None)
+                    if message is None:
+                        # Hangup: everything queued has been flushed, so close
+                        # the upstream socket. That ends openai_reader's
+                        # iterator, letting the TaskGroup exit promptly instead
+                        # of waiting for OpenAI to notice the session is dead.
+                        await ai_websocket.close()
+                        return
+                    await send_str(message)
+
+            # OpenAI -> Twilio is split into a reader and a writer joined by a
+            # deque, so a slow Twilio send never stalls the OpenAI socket and
+            # any backlog of deltas is coalesced into fewer outbound frames.
+            pending = deque()
+            wake = loop.create_future()
+
+            def push_delta(payload):
+                if payload is not None and len(pending) >= _MAX_PENDING_DELTAS:
+                    pending.popleft()
+                pending.append(payload)
+                if not wake.done():
+                    wake.set_result(None)
+
+            async def openai_reader():
+                try:
+                    async for msg in ai_websocket:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            match = _AUDIO_DELTA_RE.search(msg.data)
+                            if match:
+                                push_delta(match.group(1))
+                                continue
+                            if len(msg.data) > _LARGE_EVENT_BYTES:
+                                event = await loop.run_in_executor(_json_pool, _openai_decoder.decode, msg.data)
+                            else:
+                                event = _openai_decoder.decode(msg.data)
+                            if event.type == "response.audio.delta" and event.delta:
+                                push_delta(event.delta)
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            log.error("OpenAI WebSocket error: %s", msg)
+                except Exception:
+                    log.info("OpenAI connection closed.")
+                finally:
+                    push_delta(None)
+
+            async def twilio_writer():
+                nonlocal wake
+                # Wait for the start event once, then keep the envelope prefix
+                # in a local instead of re-reading the closure on every frame.
+                await sid_ready.wait()
+                prefix = media_prefix
+                if prefix is None:
+                    return
+                send_text = websocket.send_text
+                try:
+                    while True:
+                        while not pending:
+                            wake = loop.create_future()
+                            try:
+                                await asyncio.wait_for(wake, timeout=_KEEPALIVE_INTERVAL)
+                            except asyncio.TimeoutError:
+                                # Only pad a stream that is still live; idle
+                                # time after a hangup needs no keepalive.
+                                if websocket.client_state != WebSocketState.CONNECTED:
+                                    return
+                                await send_text(prefix + _SILENCE_B64 + _MEDIA_SUFFIX)
+                        payload = pending.popleft()
+                        if payload is None:
+                            return
+                        # Merge whatever is already queued into one frame. Base64
+                        # segments can only be joined while they are unpadded.
+                        while (pending and pending[0] is not None
+                               and not payload.endswith("=")
+                               and len(payload) < _MAX_COALESCED_B64):
+                            payload += pending.popleft()
+                        await send_text(prefix + payload + _MEDIA_SUFFIX)
+                except (WebSocketDisconnect, RuntimeError, OSError):
+                    # A send in flight can still race the hangup sentinel; a
+                    # dead Twilio socket here is routine teardown, not an error.
+                    log.info("Twilio WebSocket closed during send.")
+
+            # TaskGroup cancels the sibling coroutines as soon as one fails,
+            # so a dead socket can't leave the other direction running.
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(twilio_to_openai())
+                tg.create_task(openai_writer())
+                tg.create_task(openai_reader())
+                tg.create_task(twilio_writer())
 
     except aiohttp.ClientResponseError as e:
-        print(f"Failed to connect to OpenAI: {e.status} {e.message}")
-    except Exception as e:
-        print(f"An unhandled error occurred: {e}")
-        traceback.print_exc()
+        log.error("Failed to connect to OpenAI: %s %s", e.status, e.message)
+    except Exception:
+        log.exception("An unhandled error occurred")
     finally:
-        print("Media stream finished.")
+        log.info("Media stream finished.")
 
 
-async def setup_session(ai_ws, lang: str):
+_PROMPT_BASE = (
+    "You are an AI assistant for an anonymous employee tip line. Your tone is calm, professional, and neutral. "
+    "Your primary goal is to gather clear and detailed information about an incident. "
+    "Ask one clear question at a time and wait for the caller to finish speaking before you reply. "
+    "Your questions should guide the caller to provide information about: who was involved, what happened, "
+    "when it occurred, where it took place, and if there is any evidence. "
+)
+
+def _session_update_json(lang: str) -> str:
     language_instruction = "You MUST respond exclusively in Spanish." if lang == 'es' else "You MUST respond exclusively in English."
-    prompt = (
-        "You are an AI assistant for an anonymous employee tip line. Your tone is calm, professional, and neutral. "
-        "Your primary goal is to gather clear and detailed information about an incident. "
-        "Ask one clear question at a time and wait for the caller to finish speaking before you reply. "
-        "Your questions should guide the caller to provide information about: who was involved, what happened, "
-        "when it occurred, where it took place, and if there is any evidence. "
-        f"{language_instruction} Do not switch languages under any circumstances."
-    )
-    await ai_ws.send_str(json.dumps({
+    prompt = f"{_PROMPT_BASE}{language_instruction} Do not switch languages under any circumstances."
+    return orjson.dumps({
         "type": "session.update",
         "session": {"turn_detection": {"type": "server_vad"}, "input_audio_format": "g711_ulaw", "output_audio_format": "g711_ulaw", "voice": VOICE_ID, "instructions": prompt}
-    }))
+    }).decode()
 
-async def send_greeting(ai_ws, lang: str):
+def _greeting_json(lang: str) -> str:
     greetings = {
         "en": "Thank you for calling the anonymous tip line. How can I help you today?",
         "es": "Gracias por llamar a la línea de denuncias anónimas. ¿Cómo puedo ayudarle hoy?",
     }
-    await ai_ws.send_str(json.dumps({
+    return orjson.dumps({
         "type": "conversation.item.create",
         "item": {"type": "message", "role": "assistant", "content": [{"type": "text", "text": greetings[lang]}]}
-    }))
-    await ai_ws.send_str(json.dumps({"type": "response.create"}))
+    }).decode()
+
+# Both language variants of every control frame are constant, so serialize
+# them once at import instead of on each call.
+_SESSION_UPDATE = {lang: _session_update_json(lang) for lang in ("en", "es")}
+_GREETING = {lang: _greeting_json(lang) for lang in ("en", "es")}
+_RESPONSE_CREATE = orjson.dumps({"type": "response.create"}).decode()
+
+async def setup_session(ai_ws, lang: str):
+    await ai_ws.send_str(_SESSION_UPDATE[lang])
+
+async def send_greeting(ai_ws, lang: str):
+    await ai_ws.send_str(_GREETING[lang])
+    await ai_ws.send_str(_RESPONSE_CREATE)
 
 if __name__ == "__main__":
+    import uvicorn
     port = int(os.getenv("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools", ws="websockets", ws_per_message_deflate=False, timeout_keep_alive=30, log_level="warning", access_log=False)